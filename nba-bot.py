@@ -1,69 +1,113 @@
 import sqlite3
-from datetime import datetime, timedelta
-import pytz
+import atexit
+from datetime import date, datetime, timedelta
+from zoneinfo import ZoneInfo
 import logging
-import json
+import orjson
 import os
-import discord
-from openai import OpenAI
-# ------------------------
-# SERPER SEARCH
-# ------------------------
-from langchain_community.utilities import GoogleSerperAPIWrapper
-from langchain_openai import OpenAI
-from langchain.agents import initialize_agent, Tool
-from langchain.agents import AgentType
-from langchain.callbacks import get_openai_callback
+import argparse
+import time
 
 # ------------------------
 # CONFIG
 # ------------------------
 OPENAI_API_KEY = os.environ["OPENAI_API_KEY"]
-DISCORD_TOKEN = os.environ["DISCORD_TOKEN"]
-DISCORD_CHANNEL_ID = int(os.environ["DISCORD_CHANNEL_ID"])
-SERPER_TOKEN = os.environ["SERPER_TOKEN"]
+# une ou plusieurs URLs de webhook séparées par des virgules
+DISCORD_WEBHOOK_URLS = [url.strip() for url in os.environ.get("DISCORD_WEBHOOK_URL", "").split(",") if url.strip()]
+SERPER_TOKEN = os.environ.get("SERPER_TOKEN")
 DB_FILE = "games.db"
+TEAMS = ["Cleveland Cavaliers"]
+# la table games n'a pas de colonne équipe : seuls les matchs de cette équipe sont enregistrés
+CAVS = TEAMS[0]
 
-client_openai = OpenAI(api_key=OPENAI_API_KEY)
+_ET = ZoneInfo("America/New_York")
+_PARIS = ZoneInfo("Europe/Paris")
 
-# Initialize the Serper API Wrapper
-search = GoogleSerperAPIWrapper(serper_api_key=SERPER_TOKEN)
+# ------------------------
+# Clients OpenAI / Serper (imports différés, créés au premier appel)
+# ------------------------
+_client_openai = None
+_serper = None
 
-tools = [
-    Tool(
-        name="Intermediate Answer",
-        func=search.run,
-        description="Useful for when you need to answer questions with up-to-date information."
-    )
-]
+def get_openai():
+    global _client_openai
+    if _client_openai is None:
+        from openai import OpenAI
+        _client_openai = OpenAI(api_key=OPENAI_API_KEY)
+    return _client_openai
 
-react_agent = initialize_agent(
-    tools,
-    client_openai,
-    agent=AgentType.SELF_ASK_WITH_SEARCH,
-    verbose=True
-)
+# ------------------------
+# SERPER SEARCH (outil appelé directement par le modèle)
+# ------------------------
+def search(query: str) -> str:
+    global _serper
+    if _serper is None:
+        from langchain_community.utilities import GoogleSerperAPIWrapper
+        _serper = GoogleSerperAPIWrapper(serper_api_key=SERPER_TOKEN)
+    return _serper.run(query)
+
+SEARCH_TOOL = {
+    "type": "function",
+    "function": {
+        "name": "search",
+        "description": "Useful for when you need to answer questions with up-to-date information.",
+        "parameters": {
+            "type": "object",
+            "properties": {
+                "query": {"type": "string", "description": "Requête de recherche Google"}
+            },
+            "required": ["query"]
+        }
+    }
+}
 
 # logger
 logging.basicConfig(level=logging.INFO, format="%(asctime)s - %(levelname)s - %(message)s")
+log = logging.getLogger(__name__)
 
 
 # ------------------------
 # Fonction de conversion ET -> Paris
 # ------------------------
+# entrées à largeur fixe (YYYY-MM-DD / HH:MM) : découpage direct, sans strptime ;
+# sinon (ex. "7:30" renvoyé par le modèle) on retombe sur strptime
 def convert_et_to_paris(date_str, time_str):
-    et = pytz.timezone("US/Eastern")
-    paris = pytz.timezone("Europe/Paris")
-    dt = datetime.strptime(date_str + " " + time_str, "%Y-%m-%d %H:%M")
-    dt_et = et.localize(dt)
-    dt_paris = dt_et.astimezone(paris)
-    return dt_paris.strftime("%Y-%m-%d %H:%M")
+    if (len(date_str) == 10 and date_str[4] == "-" and date_str[7] == "-"
+            and len(time_str) == 5 and time_str[2] == ":"):
+        dt = datetime(
+            int(date_str[:4]), int(date_str[5:7]), int(date_str[8:10]),
+            int(time_str[:2]), int(time_str[3:5]),
+            tzinfo=_ET
+        )
+    else:
+        dt = datetime.strptime(f"{date_str} {time_str}", "%Y-%m-%d %H:%M").replace(tzinfo=_ET)
+    p = dt.astimezone(_PARIS)
+    return f"{p.year:04d}-{p.month:02d}-{p.day:02d} {p.hour:02d}:{p.minute:02d}"
+
+# ------------------------
+# Connexion SQLite partagée
+# ------------------------
+_conn = None
+
+def get_conn():
+    global _conn
+    if _conn is None:
+        _conn = sqlite3.connect(DB_FILE)
+        _conn.execute("PRAGMA journal_mode=WAL")
+        _conn.execute("PRAGMA synchronous=NORMAL")
+        _conn.execute("PRAGMA cache_size=-20000")
+        _conn.execute("PRAGMA mmap_size=268435456")
+        _conn.execute("PRAGMA temp_store=MEMORY")
+        _conn.create_function("to_paris", 2, convert_et_to_paris, deterministic=True)
+        # la fermeture en fin de process fait le checkpoint WAL dans games.db
+        atexit.register(_conn.close)
+    return _conn
 
 # ------------------------
 # Création BDD si nécessaire
 # ------------------------
 def init_db():
-    conn = sqlite3.connect(DB_FILE)
+    conn = get_conn()
     c = conn.cursor()
     c.execute('''
     CREATE TABLE IF NOT EXISTS games (
@@ -80,139 +124,314 @@ def init_db():
         created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
     );
     ''')
+    c.execute("SELECT 1 FROM sqlite_master WHERE type = 'index' AND name = 'ux_games_date_opp'")
+    if c.fetchone() is None:
+        # migration unique : les anciennes bases peuvent contenir des doublons, on les retire avant de poser l'index
+        c.execute('''
+        DELETE FROM games WHERE id NOT IN (SELECT MIN(id) FROM games GROUP BY date, opponent);
+        ''')
+        c.execute("CREATE UNIQUE INDEX ux_games_date_opp ON games(date, opponent);")
     conn.commit()
-    conn.close()
+
+def has_games(start, end):
+    c = get_conn().cursor()
+    c.execute("SELECT COUNT(*) FROM games WHERE date BETWEEN ? AND ?", (start.isoformat(), end.isoformat()))
+    return c.fetchone()[0] > 0
 
 # ------------------------
 # Récupération programme Cavs via OpenAI
 # ------------------------
-def fetch_cavs_schedule():
+def next_week():
     today = datetime.today().date()
     next_sunday = today + timedelta(days=(6 - today.weekday()))
     end_of_week = next_sunday + timedelta(days=6)
+    return next_sunday, end_of_week
 
-    prompt = f"""
-    Donne-moi le programme NBA des Cleveland Cavaliers pour la semaine du {next_sunday} au {end_of_week}.
+def build_prompt(next_sunday, end_of_week, teams=TEAMS):
+    return f"""
+    Donne-moi le programme NBA des équipes suivantes pour la semaine du {next_sunday} au {end_of_week} : {", ".join(teams)}.
     N'invente aucun match, et utilise uniquement les données du monde réel.
-    Pour chaque match, indique :
+    Pour chaque match de chaque équipe, indique :
     - date (YYYY-MM-DD)
     - équipe adverse
     - domicile ou extérieur
-    - classement actuel de Cleveland
+    - classement actuel de l'équipe
     - classement actuel de l'adversaire
     - heure brute en US/Eastern (HH:MM)
     - watch: "full" ou "condensed"
     - un petit résumé rapide des enjeux du match
-    Réponds uniquement en JSON dans le format suivant, sans aucun autre caractère, pour que je puisse parser directement ta réponse :
-    [
-      {{
-        "date": "YYYY-MM-DD",
-        "opponent": "Nom de l'équipe",
-        "home": true/false,
-        "team_rank": <classement Cleveland>,
-        "opponent_rank": <classement adversaire>,
-        "time_et": "HH:MM",
-        "watch": "full" ou "condensed",
-        "summary": "texte court"
+    Réponds uniquement avec un objet JSON dans le format suivant, avec une clé par équipe (nom exact ci-dessus) :
+    {{
+      "teams": {{
+        "Nom de l'équipe": [
+          {{
+            "date": "YYYY-MM-DD",
+            "opponent": "Nom de l'équipe adverse",
+            "home": true/false,
+            "team_rank": <classement de l'équipe>,
+            "opponent_rank": <classement adversaire>,
+            "time_et": "HH:MM",
+            "watch": "full" ou "condensed",
+            "summary": "texte court"
+          }}
+        ]
       }}
-    ]
+    }}
     """
 
-    logging.info("prompt complet :\n%s", prompt)
+def parse_teams(json_output, teams=TEAMS):
+    try:
+        by_team = orjson.loads(json_output)["teams"]
+    except (orjson.JSONDecodeError, KeyError, TypeError):
+        by_team = None
+    if not isinstance(by_team, dict):
+        log.error("Erreur JSON, objet \"teams\" invalide : %s", json_output)
+        by_team = {}
+
+    result = {}
+    for team in teams:
+        games = by_team.get(team)
+        if not isinstance(games, list):
+            log.error("équipe %s absente ou invalide dans la réponse (clés reçues : %s)", team, list(by_team))
+            games = []
+        result[team] = games
+    return result
 
-    with get_openai_callback() as cb:
-        try:
-            result = react_agent.run(prompt)
-            logging.info("result complet :\n%s", result)
-            print(f"\nFinal Result: {result}")
-            print(f"\nTotal Tokens: {cb.total_tokens}")
-            print(f"Prompt Tokens: {cb.prompt_tokens}")
-            print(f"Completion Tokens: {cb.completion_tokens}")
-            print(f"Total Cost (USD): ${cb.total_cost}")
-        except Exception as e:
-            print(f"An error occurred: {e}")
+# un seul appel pour toutes les équipes, même s'il n'y en a qu'une
+def fetch_schedules(teams=TEAMS, use_agent=False):
+    prompt = build_prompt(*next_week(), teams)
 
+    log.debug("prompt complet :\n%s", prompt)
 
+    client_openai = get_openai()
+    # la recherche Serper n'est proposée au modèle qu'avec --use-agent
+    tools = {"tools": [SEARCH_TOOL]} if use_agent else {}
+    messages = [{"role": "user", "content": prompt}]
     response = client_openai.chat.completions.create(
         model="gpt-5-chat-latest",
-        messages=[{"role": "user", "content": prompt}],
-        temperature=0.1
+        messages=messages,
+        temperature=0.1,
+        response_format={"type": "json_object"},
+        **tools
     )
 
-    logging.info("Réponse complète de l'API:\n%s", json.dumps(response.to_dict(), indent=2, ensure_ascii=False))
+    # un seul aller-retour de recherche, puis réponse finale sans outil
+    tool_calls = response.choices[0].message.tool_calls
+    if tool_calls:
+        messages.append(response.choices[0].message)
+        for call in tool_calls:
+            # une recherche en échec ne doit pas bloquer l'envoi du programme
+            try:
+                query = orjson.loads(call.function.arguments)["query"]
+                log.info("recherche Serper : %s", query)
+                content = search(query)
+            except Exception as e:
+                log.error("recherche Serper en échec : %r", e)
+                content = f"Erreur de recherche : {e}"
+            messages.append({"role": "tool", "tool_call_id": call.id, "content": content})
 
-    json_output = response.choices[0].message.content
-    try:
-        data = json.loads(json_output)
-        return data
-    except json.JSONDecodeError:
-        print("Erreur JSON :", json_output)
-        return []
+        response = client_openai.chat.completions.create(
+            model="gpt-5-chat-latest",
+            messages=messages,
+            temperature=0.1,
+            tools=[SEARCH_TOOL],
+            tool_choice="none",
+            response_format={"type": "json_object"}
+        )
+
+    # to_dict() + dump coûtent cher, on ne les fait que si le niveau DEBUG est actif
+    if log.isEnabledFor(logging.DEBUG):
+        log.debug("Réponse complète de l'API:\n%s", orjson.dumps(response.to_dict(), option=orjson.OPT_INDENT_2).decode())
+
+    return parse_teams(response.choices[0].message.content, teams)
+
+def fetch_cavs_schedule(use_agent=False):
+    return fetch_schedules(use_agent=use_agent)[CAVS]
+
+# ------------------------
+# Backfill de plusieurs semaines via l'API Batch OpenAI
+# ------------------------
+def submit_batch(week_starts):
+    lines = []
+    for start in week_starts:
+        lines.append(orjson.dumps({
+            "custom_id": f"cavs-{start.isoformat()}",
+            "method": "POST",
+            "url": "/v1/chat/completions",
+            "body": {
+                "model": "gpt-5-chat-latest",
+                "messages": [{"role": "user", "content": build_prompt(start, start + timedelta(days=6))}],
+                "temperature": 0.1,
+                "response_format": {"type": "json_object"}
+            }
+        }))
+
+    client_openai = get_openai()
+    batch_file = client_openai.files.create(
+        file=("cavs-batch.jsonl", b"\n".join(lines)),
+        purpose="batch"
+    )
+    batch = client_openai.batches.create(
+        input_file_id=batch_file.id,
+        endpoint="/v1/chat/completions",
+        completion_window="24h"
+    )
+    log.info("batch soumis : %s (%d semaines)", batch.id, len(lines))
+    return batch.id
+
+def collect_batch(batch_id, poll_interval=60):
+    client_openai = get_openai()
+    while True:
+        batch = client_openai.batches.retrieve(batch_id)
+        if batch.status in ("completed", "failed", "expired", "cancelled"):
+            break
+        log.info("batch %s : %s", batch_id, batch.status)
+        time.sleep(poll_interval)
+
+    # les requêtes en échec sont dans un fichier séparé, absentes de la sortie
+    if batch.error_file_id:
+        for line in client_openai.files.content(batch.error_file_id).text.splitlines():
+            item = orjson.loads(line)
+            log.error("batch %s, requête %s en échec : %s", batch_id, item["custom_id"], item.get("error") or item.get("response"))
+
+    if batch.status != "completed" or not batch.output_file_id:
+        log.error("batch %s terminé sans résultat : %s", batch_id, batch.status)
+        return {}
+
+    results = {}
+    for line in client_openai.files.content(batch.output_file_id).text.splitlines():
+        item = orjson.loads(line)
+        if item.get("error"):
+            log.error("batch %s, requête %s en échec : %s", batch_id, item["custom_id"], item["error"])
+            continue
+        content = item["response"]["body"]["choices"][0]["message"]["content"]
+        results[item["custom_id"]] = parse_teams(content)
+    return results
+
+def backfill(week_starts):
+    results = collect_batch(submit_batch(week_starts))
+    for start in week_starts:
+        by_team = results.get(f"cavs-{start.isoformat()}")
+        if by_team is None:
+            log.error("semaine du %s absente du batch, rien d'enregistré", start)
+            continue
+        save_to_db(by_team[CAVS])
+        print(f"✅ Semaine du {start} enregistrée ({len(by_team[CAVS])} matchs).")
 
 # ------------------------
 # Sauvegarde dans la BDD
 # ------------------------
 def save_to_db(data):
-    conn = sqlite3.connect(DB_FILE)
-    c = conn.cursor()
-    for match in data:
-        date_paris = convert_et_to_paris(match['date'], match['time_et'])
-        c.execute('''
-            INSERT INTO games (date, opponent, home, team_rank, opponent_rank, time_et, time_paris, watch, summary)
-            VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
-        ''', (
+    rows = [
+        (
             match['date'],
             match['opponent'],
             match['home'],
             match.get('team_rank'),
             match.get('opponent_rank'),
             match['time_et'],
-            date_paris,
             match['watch'],
             match.get('summary')
-        ))
-    conn.commit()
-    conn.close()
+        )
+        for match in data
+    ]
+    conn = get_conn()
+    # une seule transaction pour tout le lot, l'heure de Paris est calculée par SQLite
+    with conn:
+        conn.executemany('''
+            INSERT INTO games (date, opponent, home, team_rank, opponent_rank, time_et, time_paris, watch, summary)
+            VALUES (?1, ?2, ?3, ?4, ?5, ?6, to_paris(?1, ?6), ?7, ?8)
+            ON CONFLICT(date, opponent) DO NOTHING
+        ''', rows)
 
 # ------------------------
 # Envoi sur Discord
 # ------------------------
-async def send_discord_message():
-    client = discord.Client(intents=discord.Intents.default())
+def build_discord_message(start, end):
+    c = get_conn().cursor()
+    c.execute(
+        "SELECT date, opponent, home, time_paris, watch, summary FROM games WHERE date BETWEEN ? AND ? ORDER BY date",
+        (start.isoformat(), end.isoformat())
+    )
+    rows = c.fetchall()
 
-    @client.event
-    async def on_ready():
-        print(f'Logged in as {client.user}')
-        conn = sqlite3.connect(DB_FILE)
-        c = conn.cursor()
-        c.execute("SELECT date, opponent, home, time_paris, watch, summary FROM games ORDER BY date")
-        rows = c.fetchall()
-        conn.close()
+    parts = ["**📅 Programme NBA des Cavaliers (Semaine prochaine) :**\n\n"]
+    for game_date, opponent, home, time_paris, watch, summary in rows:
+        domicile = "🏠" if home else "🏟️"
+        parts.append(f"**{game_date} {time_paris}** {domicile} vs *{opponent}* → **{watch.upper()}**\n_{summary}_\n\n")
+    return "".join(parts)
 
-        message = "**📅 Programme NBA des Cavaliers (Semaine prochaine) :**\n\n"
-        for row in rows:
-            date, opponent, home, time_paris, watch, summary = row
-            domicile = "🏠" if home else "🏟️"
-            message += f"**{date} {time_paris}** {domicile} vs *{opponent}* → **{watch.upper()}**\n_{summary}_\n\n"
+# un simple POST par webhook de salon, sans connexion au gateway, envoyés en parallèle
+async def send_discord_message(message):
+    if not DISCORD_WEBHOOK_URLS:
+        raise ValueError("DISCORD_WEBHOOK_URL absente ou sans aucune URL de webhook")
 
-        channel = client.get_channel(DISCORD_CHANNEL_ID)
-        await channel.send(message)
-        await client.close()
+    import asyncio
+    import aiohttp
+    import discord
 
-    await client.start(DISCORD_TOKEN)
+    async def post(url, session):
+        webhook = discord.Webhook.from_url(url, session=session)
+        await webhook.send(content=message)
+
+    # un échec sur un salon ne doit pas annuler les envois vers les autres
+    async with aiohttp.ClientSession() as session:
+        results = await asyncio.gather(
+            *(post(url, session) for url in DISCORD_WEBHOOK_URLS),
+            return_exceptions=True
+        )
+
+    failures = 0
+    for url, result in zip(DISCORD_WEBHOOK_URLS, results):
+        if isinstance(result, Exception):
+            failures += 1
+            # l'URL contient le token du webhook, on n'en logge que le début
+            log.error("envoi Discord en échec (%s...) : %r", url[:40], result)
+    if failures == len(DISCORD_WEBHOOK_URLS):
+        raise RuntimeError("aucun message Discord n'a pu être envoyé")
 
-if not os.path.exists(DB_FILE):
-    print("📀 Aucune base trouvée, création de games.db...")
-    init_db()
-else:
-    print("✅ Base SQLite déjà existante, on continue.")
 # ------------------------
 # Main
 # ------------------------
-if __name__ == "__main__":
+def main():
+    parser = argparse.ArgumentParser(description="Programme NBA hebdomadaire des Cavaliers sur Discord")
+    parser.add_argument("--use-agent", action="store_true", help="autorise le modèle à chercher sur le web via Serper (SERPER_TOKEN requis)")
+    parser.add_argument(
+        "--backfill", nargs="+", type=date.fromisoformat, metavar="YYYY-MM-DD",
+        help="débuts de semaine (dimanches) à récupérer via l'API Batch OpenAI, sans envoi Discord"
+    )
+    args = parser.parse_args()
+
+    if args.use_agent and not SERPER_TOKEN:
+        parser.error("--use-agent nécessite la variable d'environnement SERPER_TOKEN")
+    if args.backfill:
+        if args.use_agent:
+            parser.error("--use-agent n'est pas disponible avec --backfill (pas de recherche via l'API Batch)")
+        not_sundays = [start.isoformat() for start in args.backfill if start.weekday() != 6]
+        if not_sundays:
+            parser.error(f"--backfill attend des dimanches : {', '.join(not_sundays)}")
+        # un custom_id en double fait échouer tout le batch à la validation
+        args.backfill = sorted(set(args.backfill))
+
+    if not os.path.exists(DB_FILE):
+        print("📀 Aucune base trouvée, création de games.db...")
+    else:
+        print("✅ Base SQLite déjà existante, on continue.")
     init_db()
-    matches = fetch_cavs_schedule()
-    save_to_db(matches)
+
+    if args.backfill:
+        backfill(args.backfill)
+        return
+
+    week = next_week()
+    if has_games(*week):
+        print("✅ Programme de la semaine déjà en base, pas d'appel OpenAI.")
+    else:
+        matches = fetch_cavs_schedule(use_agent=args.use_agent)
+        save_to_db(matches)
 
     import asyncio
-    asyncio.run(send_discord_message())
+    asyncio.run(send_discord_message(build_discord_message(*week)))
+
+if __name__ == "__main__":
+    main()